@@ -1,9 +1,26 @@
 import streamlit as st
 from wordcloud import WordCloud
+import copy
+import functools
+import hashlib
 import io
 import re
+import numpy as np
 import pandas as pd
-from collections import Counter
+from PIL import Image
+
+# Precompiled patterns used by parse_input
+_LINE_RE = re.compile(r'(.+?)\s+([-+]?\d*\.?\d+\s*%?)$')
+_NUMBER_RE = re.compile(r'[-+]?\d*\.?\d+%?')
+
+# Word clouds are laid out at 1/_LAYOUT_SCALE of the requested size; the
+# preview is drawn at that size, the download at full size
+_LAYOUT_SCALE = 2
+
+# Settings that affect word placement (or, for the filter values, the
+# frequencies being placed); changing anything else skips the layout
+_LAYOUT_KEYS = ('width', 'height', 'max_words', 'min_font_size', 'max_font_size', 
+                'min_frequency', 'scale')
 
 # Page configuration
 st.set_page_config(
@@ -22,14 +39,14 @@ st.markdown("""
         margin-bottom: 1rem;
         font-weight: bold;
     }
-    .stButton>button {
+    .stFormSubmitButton>button {
         background-color: #3B82F6;
         color: white;
         font-weight: bold;
         border-radius: 8px;
         border: none;
     }
-    .stButton>button:hover {
+    .stFormSubmitButton>button:hover {
         background-color: #2563EB;
     }
     .info-box {
@@ -54,130 +71,263 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Data processing functions
+def _parse_frequency(freq_str: str) -> float:
+    """Convert a frequency string (number, percentage or fraction) to float"""
+    # Handle percentages
+    if '%' in freq_str:
+        # float() doesn't treat \x1c-\x1f as whitespace, str.strip() does
+        freq = float(freq_str.replace('%', '').strip())
+        # If percentage > 1 (e.g., 50%), divide by 100
+        if freq > 1:
+            freq = freq / 100.0
+    # Handle fractions
+    elif '/' in freq_str:
+        num, denom = map(float, freq_str.split('/'))
+        freq = num / denom
+    else:
+        freq = float(freq_str)
+    
+    return freq
+
+def _parse_line(line: str) -> tuple[str, float] | None:
+    """Parse a single stripped line into a (word, frequency) pair"""
+    # Fast path for the common "word<whitespace>number" format: when the
+    # last token is a plain number the regex below would split the line
+    # the same way
+    parts = line.rsplit(None, 1)
+    if len(parts) == 2 and _NUMBER_RE.fullmatch(parts[1]):
+        word, freq_str = parts
+    # Improved parsing using regex
+    # Find the last number (possibly with % or /) in the string
+    elif match := _LINE_RE.search(line):
+        # The line is stripped and the pattern brackets both groups with
+        # whitespace, so they need no stripping of their own
+        word, freq_str = match.groups()
+    else:
+        # Try old formats for compatibility: tab, colon, then any whitespace
+        word, sep, freq_str = line.partition('\t')
+        if not sep:
+            word, sep, freq_str = line.partition(':')
+        if not sep:
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                return None
+            word, freq_str = parts
+        
+        word = word.strip()
+        freq_str = freq_str.strip()
+    
+    try:
+        freq = _parse_frequency(freq_str)
+    except ValueError:
+        # Skip lines with errors
+        return None
+    
+    if freq > 0:
+        return word, freq
+    return None
+
 def parse_input(text: str) -> dict[str, float]:
     """Parse input with improved multi-word term handling"""
-    frequencies = {}
-    lines = text.strip().split('\n')
-    
-    for line in lines:
+    pairs = []
+    # Split on '\n' only: a bare '\r' or other rare terminators stay inside
+    # the line as before, CRLF leaves a '\r' that the strip removes
+    for line in text.split('\n'):
         line = line.strip()
         if not line:
             continue
         
-        # Improved parsing using regex
-        # Find the last number (possibly with % or /) in the string
-        match = re.search(r'(.+?)\s+([-+]?\d*\.?\d+\s*%?)$', line.strip())
-        
-        if not match:
-            # Try old formats for compatibility
-            if '\t' in line:
-                parts = line.split('\t', 1)
-            elif ':' in line:
-                parts = line.split(':', 1)
-            else:
-                parts = re.split(r'\s+', line, 1)
-            
-            if len(parts) == 2:
-                word = parts[0].strip()
-                freq_str = parts[1].strip()
-            else:
-                continue
-        else:
-            word = match.group(1).strip()
-            freq_str = match.group(2).strip()
-        
-        try:
-            # Handle percentages
-            if '%' in freq_str:
-                freq_str = freq_str.replace('%', '').strip()
-                freq = float(freq_str)
-                # If percentage > 1 (e.g., 50%), divide by 100
-                if freq > 1:
-                    freq = freq / 100.0
-            # Handle fractions
-            elif '/' in freq_str:
-                num, denom = map(float, freq_str.split('/'))
-                freq = num / denom
-            else:
-                freq = float(freq_str)
-            
-            if freq > 0:
-                frequencies[word] = freq
-                
-        except ValueError:
-            # Skip lines with errors
-            continue
+        parsed = _parse_line(line)
+        if parsed:
+            pairs.append(parsed)
+    
+    # Build the dict once; later duplicates overwrite earlier ones
+    return dict(pairs)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _parse_cached(text: str) -> dict[str, float]:
+    """Parse input with caching, so changing only the filters reuses the parse"""
+    return parse_input(text)
+
+def _top_indices(vals: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest values, largest first, ties in input order"""
+    if len(vals) > k:
+        # Partial sort to find the cut-off value, ties at the cut-off
+        # are taken in input order like a stable sort
+        cutoff = -np.partition(-vals, k - 1)[k - 1]
+        above = np.flatnonzero(vals > cutoff)
+        ties = np.flatnonzero(vals == cutoff)[:k - len(above)]
+        idx = np.concatenate([above, ties])
+    else:
+        idx = np.arange(len(vals))
+    
+    return idx[np.argsort(-vals[idx], kind='stable')]
+
+def _filter_kernel(vals: np.ndarray, 
+                   min_freq: float, 
+                   scale: float, 
+                   max_words: int) -> tuple[np.ndarray, np.ndarray]:
+    """Filter, scale and pick the top words from an array of frequencies
+    
+    Returns the indices of the kept words and their scaled frequencies.
+    """
+    # Apply minimum frequency
+    idx = np.flatnonzero(vals >= min_freq)
+    
+    # Scale frequencies (in place on the filtered copy)
+    out = vals[idx]
+    out *= scale
+    
+    # Limit number of words
+    if len(out) > max_words:
+        top = _top_indices(out, max_words)
+        idx = idx[top]
+        out = out[top]
     
-    return frequencies
+    return idx, out
 
-def normalize_frequencies(frequencies: dict[str, float]) -> dict[str, float]:
-    """Normalize frequencies to 0-1 range"""
+def normalize_and_filter(frequencies: dict[str, float], 
+                         min_freq: float, 
+                         scale: float, 
+                         max_words: int) -> dict[str, float]:
+    """Normalize frequencies to 0-1 range, then apply filters and scaling"""
     if not frequencies:
-        return frequencies
+        return {}
     
-    max_freq = max(frequencies.values())
+    keys = list(frequencies)
+    vals = np.fromiter(frequencies.values(), dtype=np.float64, count=len(frequencies))
     
     # Normalize only if there are large numbers
+    max_freq = vals.max()
     if max_freq > 1.0:
-        return {word: freq / max_freq for word, freq in frequencies.items()}
+        vals /= max_freq
     
-    return frequencies
-
-def apply_filters(frequencies: dict[str, float], 
-                  min_freq: float, 
-                  scale: float, 
-                  max_words: int) -> dict[str, float]:
-    """Apply filters and scaling"""
-    # Apply minimum frequency
-    filtered = {k: v for k, v in frequencies.items() if v >= min_freq}
+    idx, vals = _filter_kernel(vals, min_freq, scale, max_words)
     
-    if not filtered:
-        return {}
-    
-    # Scale frequencies
-    scaled = {k: v * scale for k, v in filtered.items()}
+    return dict(zip([keys[i] for i in idx], vals.tolist()))
+
+def compute_statistics(frequencies: dict[str, float]) -> dict:
+    """Compute statistics for non-empty frequencies
     
-    # Limit number of words
-    if len(scaled) > max_words:
-        sorted_items = sorted(scaled.items(), key=lambda x: x[1], reverse=True)
-        scaled = dict(sorted_items[:max_words])
+    Returns a plain dict: it is cached by st.cache_data, which can't pickle
+    classes defined in the script once Streamlit swaps __main__ on rerun.
+    """
+    keys = list(frequencies)
+    vals = np.fromiter(frequencies.values(), dtype=np.float64, count=len(frequencies))
+    top = _top_indices(vals, 20)
+    
+    # Top words table, numbered from 1
+    top_words = pd.DataFrame({'Word': [keys[i] for i in top], 'Frequency': vals[top]}, 
+                             index=pd.RangeIndex(1, len(top) + 1))
+    
+    return {
+        'count': len(vals),
+        'minimum': float(vals.min()),
+        'maximum': float(vals.max()),
+        'average': float(vals.mean()),
+        'top_words': top_words
+    }
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def prepare_frequencies(text: str, 
+                        min_freq: float, 
+                        scale: float, 
+                        max_words: int) -> tuple[dict[str, float], int, dict | None]:
+    """Parse, normalize and filter input with caching
+    
+    Returns the filtered frequencies, the number of recognized words and
+    statistics for the filtered frequencies (None if nothing is left).
+    """
+    # Parsed through its own cache, so changing only the filters reuses it
+    frequencies = _parse_cached(text)
+    total_words = len(frequencies)
+    frequencies = normalize_and_filter(frequencies, min_freq, scale, max_words)
+    stats = compute_statistics(frequencies) if frequencies else None
     
-    return scaled
+    return frequencies, total_words, stats
 
-@st.cache_data(show_spinner=False)
-def generate_wordcloud_image(frequencies: dict[str, float], 
-                            settings: dict) -> io.BytesIO:
-    """Generate word cloud image with caching"""
-    if not frequencies:
+def _text_digest(text: str) -> str:
+    """Stable digest of the input text, used as a compact cache key"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _layout_wordcloud(text_digest: str, 
+                      _frequencies: dict[str, float], 
+                      layout: dict) -> WordCloud | None:
+    """Lay out the word cloud at reduced size with caching
+    
+    The frequencies are not hashed: they are fully determined by the input
+    text (identified by its digest) and the filter values in layout.
+    Colors don't affect placement and are applied when drawing.
+    """
+    if not _frequencies:
         return None
     
-    # Create word cloud
+    # Create word cloud; the layout runs on a canvas _LAYOUT_SCALE times
+    # smaller, drawing at that scale restores the requested size
     wordcloud = WordCloud(
-        width=settings['width'],
-        height=settings['height'],
-        background_color=settings['background_color'],
-        colormap=settings['colormap'],
-        max_words=settings['max_words'],
-        min_font_size=settings['min_font_size'],
-        max_font_size=settings['max_font_size'],
+        width=layout['width'] // _LAYOUT_SCALE,
+        height=layout['height'] // _LAYOUT_SCALE,
+        max_words=layout['max_words'],
+        # Round the minimum up so no word is drawn below the chosen size
+        min_font_size=-(-layout['min_font_size'] // _LAYOUT_SCALE),
+        max_font_size=layout['max_font_size'] // _LAYOUT_SCALE,
         random_state=42,
         collocations=False,
         prefer_horizontal=0.8,
-        margin=2
+        margin=2 // _LAYOUT_SCALE
     )
     
     # Generate word cloud
-    wordcloud.generate_from_frequencies(frequencies)
+    wordcloud.generate_from_frequencies(_frequencies)
+    
+    return wordcloud
+
+def _render_image(wordcloud: WordCloud, 
+                  settings: dict, 
+                  scale: int = _LAYOUT_SCALE) -> Image.Image:
+    """Color a laid out word cloud and draw it (at full size by default)"""
+    wordcloud = copy.copy(wordcloud)
+    wordcloud.background_color = settings['background_color']
+    wordcloud.recolor(colormap=settings['colormap'], random_state=42)
+    wordcloud.scale = scale
+    return wordcloud.to_image()
+
+def _encode_preview(img: Image.Image) -> bytes:
+    """Encode the on-screen preview, drawn at layout size
+    
+    The browser scales the preview to the column width anyway.
+    """
+    # The size thresholds refer to the full-size image
+    large = img.width * _LAYOUT_SCALE >= 1200 or img.height * _LAYOUT_SCALE >= 900
+    buf = io.BytesIO()
+    if large:
+        # PNG encoding time grows with pixel count, JPEG is much faster
+        img.convert("RGB").save(buf, format="JPEG", quality=85, optimize=False)
+    else:
+        img.save(buf, format="PNG", compress_level=1)
+    
+    return buf.getvalue()
+
+def _encode_download(wordcloud: WordCloud, settings: dict, indexed: bool = False) -> bytes:
+    """Draw and encode the downloadable PNG, optionally with an indexed palette
+    
+    Called only when the download is requested, so the session keeps the
+    small laid out word cloud rather than the full-size image.
+    """
+    img = _render_image(wordcloud, settings)
+    if indexed:
+        # Word clouds use few distinct colors, so a 256-color palette
+        # roughly halves the file at a small cost in edge antialiasing
+        img = img.convert("P", palette=Image.Palette.ADAPTIVE, colors=256)
     
-    # Convert to PIL Image and then to BytesIO
-    img = wordcloud.to_image()
     buf = io.BytesIO()
-    img.save(buf, format="PNG", optimize=True, quality=95)
-    buf.seek(0)
+    # Low zlib level: slightly larger file, much faster encoding
+    img.save(buf, format="PNG", compress_level=1)
     
-    return buf
+    return buf.getvalue()
 
-def display_statistics(frequencies: dict[str, float], 
+def display_statistics(stats: dict, 
                       total_words: int,
                       settings: dict):
     """Display statistics"""
@@ -187,41 +337,33 @@ def display_statistics(frequencies: dict[str, float],
         with st.container(border=True):
             st.markdown("**📈 Basic Statistics**")
             st.write(f"Total words: **{total_words}**")
-            st.write(f"After filters: **{len(frequencies)}**")
+            st.write(f"After filters: **{stats['count']}**")
             st.write(f"Min. frequency: **{settings['min_frequency']}**")
             st.write(f"Scale: **×{settings['scale']}**")
     
     with col2:
         with st.container(border=True):
             st.markdown("**🎯 Frequency Range**")
-            if frequencies:
-                min_val = min(frequencies.values())
-                max_val = max(frequencies.values())
-                avg_val = sum(frequencies.values()) / len(frequencies)
-                st.write(f"Minimum: **{min_val:.4f}**")
-                st.write(f"Maximum: **{max_val:.4f}**")
-                st.write(f"Average: **{avg_val:.4f}**")
+            st.write(f"Minimum: **{stats['minimum']:.4f}**")
+            st.write(f"Maximum: **{stats['maximum']:.4f}**")
+            st.write(f"Average: **{stats['average']:.4f}**")
     
     # Top 20 words
     st.markdown("**🏆 Top 20 Words by Frequency:**")
-    sorted_words = sorted(frequencies.items(), key=lambda x: x[1], reverse=True)[:20]
-    
-    # Create DataFrame for nice display
-    df = pd.DataFrame(sorted_words, columns=['Word', 'Frequency'])
-    df.index = df.index + 1  # Start from 1 instead of 0
+    df = stats['top_words']
     
     # Display in 2 columns
     col1, col2 = st.columns(2)
     half = len(df) // 2 + len(df) % 2
     
     with col1:
-        st.dataframe(df.iloc[:half][['Word', 'Frequency']], 
+        st.dataframe(df.iloc[:half], 
                     use_container_width=True,
                     hide_index=False)
     
     with col2:
         if len(df) > half:
-            st.dataframe(df.iloc[half:][['Word', 'Frequency']], 
+            st.dataframe(df.iloc[half:], 
                         use_container_width=True,
                         hide_index=False)
 
@@ -268,6 +410,9 @@ with st.sidebar:
     
     # Background color
     background_color = st.color_picker("Background color", "#FFFFFF")
+    
+    # Output settings
+    optimize_png = st.toggle("Optimize PNG (indexed colors)", value=False)
 
 # Main area
 with st.container():
@@ -304,24 +449,20 @@ Metallurgy\t391
 Nanotechnology\t285
 Biomaterials\t267"""
 
-    input_data = st.text_area(
-        "Enter words and frequencies (one per line):",
-        value=default_data,
-        height=200,
-        label_visibility="collapsed"
-    )
-    
-    # Real-time word count preview
-    parsed_data = parse_input(input_data)
-    if parsed_data:
-        st.caption(f"✅ Words recognized: {len(parsed_data)}")
-    else:
-        st.caption("ℹ️ Enter data in the specified format")
-
-# Control buttons
-col1, col2, col3 = st.columns([1, 2, 1])
-with col2:
-    generate_btn = st.button("🎯 Generate Word Cloud", use_container_width=True)
+    # The text and the button share a form, so editing the text doesn't
+    # rerun the script until the word cloud is requested
+    with st.form("input_form", border=False):
+        input_data = st.text_area(
+            "Enter words and frequencies (one per line):",
+            value=default_data,
+            height=200,
+            label_visibility="collapsed"
+        )
+        
+        # Control buttons
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col2:
+            generate_btn = st.form_submit_button("🎯 Generate Word Cloud", use_container_width=True)
 
 # Processing generation
 if generate_btn:
@@ -331,16 +472,13 @@ if generate_btn:
     
     with st.spinner("🔄 Processing data..."):
         # Parse and process data
-        frequencies = parse_input(input_data)
+        frequencies, total_words, stats = prepare_frequencies(input_data, min_frequency, 
+                                                              scale, max_words)
         
-        if not frequencies:
+        if not total_words:
             st.error("❌ Could not recognize data. Please check input format.")
             st.stop()
         
-        total_words = len(frequencies)
-        frequencies = normalize_frequencies(frequencies)
-        frequencies = apply_filters(frequencies, min_frequency, scale, max_words)
-        
         if not frequencies:
             st.error(f"❌ No words with frequency above {min_frequency}!")
             st.stop()
@@ -360,22 +498,27 @@ if generate_btn:
         
         # Generate image
         with st.spinner("🎨 Generating word cloud..."):
-            img_buffer = generate_wordcloud_image(frequencies, settings)
+            layout = {key: settings[key] for key in _LAYOUT_KEYS}
+            wordcloud = _layout_wordcloud(_text_digest(input_data), frequencies, layout)
         
         # Display result
         st.markdown("---")
         st.markdown("### ☁️ Result")
         
-        if img_buffer:
+        if wordcloud is not None:
+            # The preview is drawn at layout size; the full-size image is
+            # drawn only for the download (colors are seeded, so they match)
+            preview = _encode_preview(_render_image(wordcloud, settings, scale=1))
+            
             # Display image
             col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
-                st.image(img_buffer, use_container_width=True)
+                st.image(preview, use_container_width=True)
             
-            # Download button
+            # Download button (PNG is drawn and encoded only on click)
             st.download_button(
                 label="⬇️ Download Image (PNG)",
-                data=img_buffer,
+                data=functools.partial(_encode_download, wordcloud, settings, optimize_png),
                 file_name="wordcloud.png",
                 mime="image/png",
                 use_container_width=True
@@ -384,26 +527,30 @@ if generate_btn:
             # Statistics
             st.markdown("---")
             st.markdown("### 📊 Statistics")
-            display_statistics(frequencies, total_words, settings)
+            display_statistics(stats, total_words, settings)
             
             # Save to session state for potential reuse
-            st.session_state['last_image'] = img_buffer.getvalue()
-            st.session_state['last_frequencies'] = frequencies
+            st.session_state['last_wordcloud'] = wordcloud
+            st.session_state['last_preview'] = preview
+            st.session_state['last_stats'] = stats
             st.session_state['last_settings'] = settings
             st.session_state['total_words'] = total_words
 
 # Show last result if exists
-elif 'last_image' in st.session_state:
+elif 'last_wordcloud' in st.session_state:
     st.markdown("### ☁️ Last Generated Word Cloud")
     
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        st.image(st.session_state['last_image'], use_container_width=True)
+        st.image(st.session_state['last_preview'], use_container_width=True)
     
     # Download button
     st.download_button(
         label="⬇️ Download Image (PNG)",
-        data=st.session_state['last_image'],
+        data=functools.partial(_encode_download, 
+                               st.session_state['last_wordcloud'], 
+                               st.session_state['last_settings'], 
+                               optimize_png),
         file_name="wordcloud.png",
         mime="image/png",
         use_container_width=True
@@ -413,7 +560,7 @@ elif 'last_image' in st.session_state:
     st.markdown("---")
     st.markdown("### 📊 Statistics")
     display_statistics(
-        st.session_state['last_frequencies'],
+        st.session_state['last_stats'],
         st.session_state['total_words'],
         st.session_state['last_settings']
     )